@@ -1,170 +1,485 @@
-# graph.py - State graph module
+# graph.py - Conversation state and nodes
 import os
+import re
+import asyncio
+import functools
+import hashlib
+import tempfile
+from collections import deque
+from itertools import islice
+import diskcache
+import httpx
+import numpy as np
+import msgspec
 from dotenv import load_dotenv
-from langgraph.graph import StateGraph, END
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain_core.messages import HumanMessage
+from prometheus_client import Counter
 
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEY not set in environment")
 
-# Initialize Gemini LLM via LangChain
+GEMINI_MODEL = "gemini-1.5-flash"
+
+# Connection pool settings for every Gemini HTTP client, so concurrent turns reuse keep-alive connections
+GEMINI_CLIENT_ARGS = {
+    "http2": True,
+    "limits": httpx.Limits(max_connections=200, max_keepalive_connections=50)
+}
+GEMINI_TIMEOUT = 30  # seconds
+GEMINI_ATTEMPTS = 3  # retried with exponential backoff on 429/5xx
+
+# Initialize Gemini LLM via LangChain (built once at import so its HTTP client is reused across requests)
 model = ChatGoogleGenerativeAI(
-    model="gemini-1.5-flash",
+    model=GEMINI_MODEL,
+    google_api_key=GOOGLE_API_KEY,
+    temperature=0.7,
+    client_args=GEMINI_CLIENT_ARGS,
+    timeout=GEMINI_TIMEOUT,
+    max_retries=GEMINI_ATTEMPTS
+)
+
+# Embeddings used to recognise paraphrased follow-up questions
+embedder = GoogleGenerativeAIEmbeddings(
+    model="models/text-embedding-004",
     google_api_key=GOOGLE_API_KEY,
-    temperature=0.7
+    client_args=GEMINI_CLIENT_ARGS
+)
+
+# Number of conversation_history entries kept for follow-up prompts (three question/answer turns)
+HISTORY_WINDOW = 6
+
+# Phrases that end the conversation when they appear in a follow-up, compiled once at import
+END_RE = re.compile(
+    r"\b(thanks|thank you|bye|goodbye|that'?s all|no more questions|that'?s enough|done|finish|end|exit|quit)\b",
+    re.IGNORECASE
+)
+
+# Minimum cosine similarity for a follow-up to reuse a previous answer
+SEMANTIC_CACHE_THRESHOLD = 0.85
+# Previous answers kept per conversation for semantic reuse (oldest dropped first)
+SEMANTIC_CACHE_SIZE = 8
+
+# Canonical answers for "what is X?" style follow-ups, served without calling Gemini
+FAQ = {
+    "sip": "A **SIP (Systematic Investment Plan)** lets you invest a fixed amount in a mutual fund every month through auto-debit. "
+           "Buying regularly averages out your purchase price over market ups and downs (rupee-cost averaging), and you can start with as little as ₹500. "
+           "To begin, complete your KYC, pick a fund (an index fund is a good first choice) and set up the mandate on the AMC's site or an investment app.",
+    "ppf": "The **PPF (Public Provident Fund)** is a government-backed savings scheme with a 15-year lock-in that can be extended in 5-year blocks. "
+           "You can deposit ₹500 to ₹1.5 lakh per financial year, the interest is tax-free, and under the old tax regime deposits qualify for the Section 80C deduction. "
+           "It suits safe, long-term goals like retirement or a child's education.",
+    "elss": "An **ELSS (Equity Linked Savings Scheme)** is an equity mutual fund with a 3-year lock-in, the shortest among Section 80C options under the old tax regime. "
+            "Returns depend on the stock market, so it fits goals that are at least 5 years away. You can invest through a SIP to spread out the risk.",
+    "emergency fund": "An **emergency fund** is money set aside for surprises such as a job loss, medical bills or urgent repairs. "
+                      "Aim for 3-6 months of essential expenses, kept somewhere safe and easy to withdraw, like a savings account, sweep-in FD or liquid mutual fund. "
+                      "Build it before you start investing aggressively.",
+    "term insurance": "**Term insurance** is pure life cover: if you pass away during the policy term your family receives the sum assured, and there is no maturity payout. "
+                      "That keeps premiums low. A common rule of thumb is cover of 10-15 times your annual income, and buying young locks in cheaper premiums.",
+    "health insurance": "**Health insurance** pays for hospitalisation and treatment costs. Even if your employer covers you, keep a personal or family floater policy "
+                        "(₹5-10 lakh is a common starting point) so you stay protected if you change jobs. Premiums qualify for the Section 80D deduction under the old tax regime.",
+    "index fund": "An **index fund** is a mutual fund that simply tracks a market index such as the Nifty 50 or Sensex. "
+                  "Because it isn't actively managed, its expense ratio is low, and over the long run it matches the market's returns. "
+                  "It's a simple, low-cost core holding for a SIP.",
+    "nps": "The **NPS (National Pension System)** is a government-regulated, market-linked retirement scheme. "
+           "Most of the money stays locked in until age 60, and under the old tax regime you get an extra deduction of up to ₹50,000 under Section 80CCD(1B), over and above 80C. "
+           "It's a disciplined way to build a retirement corpus.",
+}
+# Only bare definitional questions; anything after the term ("...for 5000 a month?", "...vs PPF") goes to Gemini
+FAQ_RE = re.compile(
+    r"\b(?:what(?:'?s| is| are)|define|explain|meaning of)\s+(?:an?\s+|the\s+)?(" + "|".join(FAQ) + r")s?\s*[?.!]*\s*$",
+    re.IGNORECASE
 )
 
+# Where follow-up answers come from, so the FAQ and cache hit rates can be watched
+FOLLOWUP_ANSWERS = Counter("followup_answers", "Follow-up answers by source", ["source"])
+# Persona opening every Gemini prompt
+ADVISOR_PERSONA = "You are a friendly and knowledgeable Indian financial advisor."
+
+# Fixed assistant turns that never need the LLM
+ASK_NAME_MSG = {"role": "assistant", "content": "Hi! What is your name?"}
+ASK_SALARY_TEMPLATE = (
+    "Namaste {name}! 👋 I’m your friendly Indian financial advisor, here to guide you with smart budgeting, "
+    "savings, investments, and insurance tips. To get started, could you please share your monthly salary?"
+).format
+
+# Per-turn prompt templates, bound once so each turn only fills in the slots
+ADVICE_TEMPLATE = (
+    ADVISOR_PERSONA + " "
+    "The user's name is {name} (write it exactly like that, it is filled in later) "
+    "and their monthly salary is ₹{salary}. "
+    "Analyze their salary and create a personalized, detailed money management plan. "
+    "Break down their salary into percentages and rupee amounts for needs, wants, savings, investments, and insurance. "
+    "Include actionable advice for: \n"
+    "1. Budgeting (using a 50-30-20 or similar rule)\n"
+    "2. Building an emergency fund\n"
+    "3. Suitable insurance coverage (term life, health, etc.)\n"
+    "4. Investment options (SIPs, PPF, ELSS, index funds)\n"
+    "5. Short-term and long-term savings tips\n"
+    "6. Practical money habits to follow in India.\n"
+    "Make the advice structured, clear, and motivational also End by asking if they have any other questions."
+).format
+FOLLOWUP_TEMPLATE = (
+    ADVISOR_PERSONA + " Here's the context:\n"
+    "- User's name: {name}\n"
+    "- Monthly salary: {salary} INR\n"
+    "- Initial advice given: {initial_advice}\n\n"
+    "Previous conversation:\n{previous_context}\n\n"
+    "The user is asking a follow-up question: \"{question}\"\n\n"
+    "Provide a helpful, detailed answer that builds on the previous advice. Keep it friendly and practical. "
+    "If the question is unclear, ask for clarification. End by asking if they have any other questions."
+).format
+
+# Advice is cached per salary bracket with a name placeholder, and persisted across restarts
+ADVICE_NAME_SLOT = "{NAME}"
+ADVICE_SALARY_DIGITS = 2  # brackets keep two significant figures, so the quoted salary is within 5% of the real one
+ADVICE_TTL = 7 * 24 * 3600  # seconds
+# Changing the model or the advice prompt starts a fresh set of keys instead of serving stale plans
+ADVICE_KEY_PREFIX = hashlib.blake2b(
+    f"{GEMINI_MODEL}:{ADVICE_TEMPLATE(name=ADVICE_NAME_SLOT, salary='')}".encode(), digest_size=4
+).hexdigest()
+ADVICE_CACHE_DIR = os.getenv("ADVICE_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "smartsalary_advice")
+
+# Limits blocking calls handed to threads, so a burst of turns can't exhaust the executor
+BLOCKING_SLOTS = asyncio.Semaphore(32)
+
 # Define state structure
-class State(dict):
-    name: str
-    salary: float
-    step: str
-    messages: list
-    conversation_history: list
-    initial_advice: str
+class State(msgspec.Struct):
+    name: str = ""
+    salary: float = 0.0
+    step: str = ""
+    messages: list = []
+    conversation_history: list = msgspec.field(default_factory=lambda: deque(maxlen=HISTORY_WINDOW))
+    initial_advice: str = ""
+    followup_question: str = ""
+    qa_vectors: list[bytes] = msgspec.field(default_factory=lambda: deque(maxlen=SEMANTIC_CACHE_SIZE))
+    qa_answers: list[str] = msgspec.field(default_factory=lambda: deque(maxlen=SEMANTIC_CACHE_SIZE))
+
+    def __post_init__(self):
+        # Decoded states arrive with plain lists; restore the ring buffers and float32 vectors
+        if not isinstance(self.conversation_history, deque):
+            self.conversation_history = deque(self.conversation_history, maxlen=HISTORY_WINDOW)
+        if not isinstance(self.qa_vectors, deque):
+            self.qa_vectors = deque(
+                (np.frombuffer(vector, dtype=np.float32) for vector in self.qa_vectors),
+                maxlen=SEMANTIC_CACHE_SIZE
+            )
+        if not isinstance(self.qa_answers, deque):
+            self.qa_answers = deque(self.qa_answers, maxlen=SEMANTIC_CACHE_SIZE)
+
+
+def _encode_extra(obj):
+    if isinstance(obj, deque):
+        return list(obj)
+    if isinstance(obj, np.ndarray):
+        # Raw float32 bytes (base64 in JSON) are about a third the size of a list of floats
+        return obj.astype(np.float32).tobytes()
+    raise NotImplementedError(f"Cannot encode {type(obj).__name__}")
+
+
+_state_encoder = msgspec.json.Encoder(enc_hook=_encode_extra)
+_state_decoder = msgspec.json.Decoder(State)
+
+
+def serialize_state(state: State) -> bytes:
+    """Encode a State as JSON bytes for storage outside the process"""
+    return _state_encoder.encode(state)
+
+
+def deserialize_state(data: bytes) -> State:
+    """Rebuild a State from serialize_state output"""
+    return _state_decoder.decode(data)
+
+
+# Fallback response if Gemini API fails
+GEMINI_FALLBACK = "I apologize, but I'm having trouble generating personalized advice right now. Here's some general financial guidance: Consider creating a budget, building an emergency fund with 3-6 months of expenses, and investing in your retirement. Please try again later for personalized advice."
+
+
+# Gemini calls in flight, keyed by prompt hash, so identical concurrent prompts share one call
+_inflight = {}
+
+
+def coalesce(prompt: str, call):
+    """Await call(prompt), joining an identical call that is already running instead of starting another"""
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(call(prompt))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shielded so one caller going away doesn't cancel the answer for everyone else
+    return asyncio.shield(task)
 
 
 # Gemini helper prompt invocation
-def ask_gemini(prompt: str) -> str:
+async def ask_gemini(prompt: str) -> str:
+    return await coalesce(prompt, _invoke_gemini)
+
+
+async def _invoke_gemini(prompt: str) -> str:
     try:
-        response = model.invoke([HumanMessage(content=prompt)])
+        response = await model.ainvoke([HumanMessage(content=prompt)])
         return response.content.strip()
     except Exception as e:
-        # Fallback response if Gemini API fails
-        return f"I apologize, but I'm having trouble generating personalized advice right now. Here's some general financial guidance: Consider creating a budget, building an emergency fund with 3-6 months of expenses, and investing in your retirement. Please try again later for personalized advice."
+        return GEMINI_FALLBACK
+
+
+async def stream_gemini(prompt: str):
+    """Yield response text from Gemini as it is generated.
+
+    Falls back to GEMINI_FALLBACK if Gemini fails before sending anything; a failure midway is re-raised,
+    so a truncated reply is never mistaken for a complete one.
+    """
+    streamed = False
+    try:
+        async for chunk in model.astream([HumanMessage(content=prompt)]):
+            if chunk.content:
+                streamed = True
+                yield chunk.content
+    except Exception as e:
+        if streamed:
+            raise
+        yield GEMINI_FALLBACK
+
+
+async def embed_question(question: str):
+    """Return a unit-length float32 embedding for the question, or None if embedding fails"""
+    try:
+        vector = np.asarray(await embedder.aembed_query(question), dtype=np.float32)
+    except Exception as e:
+        return None
+    norm = np.linalg.norm(vector)
+    if not norm:
+        return None
+    return vector / norm
 
 
 # Conversation nodes
 def ask_name(state: State):
-    state["step"] = "ask_name"
-    state.setdefault("messages", [])
-    state["messages"].append({"role": "assistant", "content": "Hi! What is your name?"})
+    state.step = "ask_name"
+    state.messages.append(ASK_NAME_MSG)
     return state
 
 
 def ask_salary(state: State):
-    state["step"] = "ask_salary"
-    state.setdefault("messages", [])
-    state["messages"].append(
-        {
-            "role": "assistant",
-            "content": f"Namaste {state['name']}! 👋 I’m your friendly Indian financial advisor, here to guide you with smart budgeting, savings, investments, and insurance tips. To get started, could you please share your monthly salary?"
-        }
-    )
+    state.step = "ask_salary"
+    state.messages.append({"role": "assistant", "content": ASK_SALARY_TEMPLATE(name=state.name)})
     return state
 
 
-def give_advice(state: State):
-    state["step"] = "advice"
-    state.setdefault("messages", [])
-    state.setdefault("conversation_history", [])
-
-    prompt = (
-        f"You are a friendly and knowledgeable Indian financial advisor. "
-        f"The user's name is {state['name']} and their monthly salary is ₹{state['salary']}. "
-        "Analyze their salary and create a personalized, detailed money management plan. "
-        "Break down their salary into percentages and rupee amounts for needs, wants, savings, investments, and insurance. "
-        "Include actionable advice for: \n"
-        "1. Budgeting (using a 50-30-20 or similar rule)\n"
-        "2. Building an emergency fund\n"
-        "3. Suitable insurance coverage (term life, health, etc.)\n"
-        "4. Investment options (SIPs, PPF, ELSS, index funds)\n"
-        "5. Short-term and long-term savings tips\n"
-        "6. Practical money habits to follow in India.\n"
-        "Make the advice structured, clear, and motivational also End by asking if they have any other questions."
-    )
+def salary_bucket(salary: float) -> int:
+    return max(int(float(f"{salary:.{ADVICE_SALARY_DIGITS}g}")), 1)
+
+
+def advice_prompt(state: State) -> str:
+    return ADVICE_TEMPLATE(name=ADVICE_NAME_SLOT, salary=salary_bucket(state.salary))
+
+
+async def run_blocking(func, *args):
+    """Run a synchronous call in the default executor instead of on the event loop"""
+    async with BLOCKING_SLOTS:
+        return await asyncio.to_thread(func, *args)
+
+
+@functools.cache
+def advice_cache():
+    """Open the advice cache on first use, or return None if its directory can't be created (read-only filesystem)"""
+    try:
+        return diskcache.Cache(ADVICE_CACHE_DIR)
+    except Exception as e:
+        return None
+
+
+def advice_key(state: State) -> str:
+    return f"{ADVICE_KEY_PREFIX}:{salary_bucket(state.salary)}"
+
+
+def _read_advice(key: str):
+    cache = advice_cache()
+    return cache.get(key) if cache is not None else None
+
+
+def _write_advice(key: str, template: str):
+    cache = advice_cache()
+    if cache is not None:
+        cache.set(key, template, expire=ADVICE_TTL)
+
+
+async def cached_advice(state: State):
+    # diskcache is SQLite underneath and can wait on file locks held by other workers
+    template = await run_blocking(_read_advice, advice_key(state))
+    if template is None:
+        return None
+    return template.replace(ADVICE_NAME_SLOT, state.name)
+
+
+async def store_advice(state: State, template: str):
+    if template != GEMINI_FALLBACK:
+        await run_blocking(_write_advice, advice_key(state), template)
+
 
-    advice = ask_gemini(prompt)
+async def fill_name(chunks, name: str):
+    """Replace the name placeholder in streamed text, holding back a placeholder split across chunks"""
+    pending = ""
+    async for chunk in chunks:
+        pending += chunk
+        cut = pending.rfind("{")
+        if cut == -1 or "}" in pending[cut:] or len(pending) - cut >= len(ADVICE_NAME_SLOT):
+            cut = len(pending)
+        if cut:
+            yield pending[:cut].replace(ADVICE_NAME_SLOT, name)
+            pending = pending[cut:]
+    if pending:
+        yield pending.replace(ADVICE_NAME_SLOT, name)
 
+
+def record_advice(state: State, advice: str):
     # Store the initial advice for future reference
-    state["initial_advice"] = advice
+    state.initial_advice = advice
 
     # Add to conversation history
-    state["conversation_history"].append({
+    state.conversation_history.append({
         "role": "system",
-        "content": f"Initial advice given for {state['name']} (salary: ${state['salary']}): {advice}"
+        "content": f"Initial advice given for {state.name} (salary: ${state.salary}): {advice}"
     })
 
-    state["messages"].append({"role": "assistant", "content": advice})
+    state.messages.append({"role": "assistant", "content": advice})
 
     # Move to followup step instead of ending
-    state["step"] = "followup"
+    state.step = "followup"
+
+
+async def give_advice(state: State):
+    state.step = "advice"
+
+    advice = await cached_advice(state)
+    if advice is None:
+        template = await ask_gemini(advice_prompt(state))
+        await store_advice(state, template)
+        advice = template.replace(ADVICE_NAME_SLOT, state.name)
+    record_advice(state, advice)
     return state
 
 
-def handle_followup(state: State):
-    """Handle follow-up questions about financial advice"""
-    state["step"] = "followup"
-    state.setdefault("messages", [])
-    state.setdefault("conversation_history", [])
+async def stream_advice(state: State):
+    """Yield the advice as Gemini generates it, recording it in the state once complete"""
+    state.step = "advice"
+
+    advice = await cached_advice(state)
+    if advice is not None:
+        yield advice
+        record_advice(state, advice)
+        return
+
+    chunks = []
+
+    async def generate():
+        async for chunk in stream_gemini(advice_prompt(state)):
+            chunks.append(chunk)
+            yield chunk
+
+    async for chunk in fill_name(generate(), state.name):
+        yield chunk
+    template = "".join(chunks).strip()
+    await store_advice(state, template)
+    record_advice(state, template.replace(ADVICE_NAME_SLOT, state.name))
+
+
+async def start_followup(state: State):
+    """Answer a follow-up without Gemini where possible.
+
+    Returns None if the turn is already answered (conversation ended or a paraphrase was reused),
+    otherwise the (prompt, question_vector) pair to complete the turn with.
+    """
+    state.step = "followup"
 
     # Get the user's follow-up question from the last message
-    user_question = state.get("followup_question", "")
+    user_question = state.followup_question
 
     # Check if user wants to end the conversation
-    end_phrases = ["thanks", "thank you", "bye", "goodbye", "that's all", "no more questions",
-                   "that's enough", "done", "finish", "end", "exit", "quit"]
-
-    if any(phrase in user_question.lower() for phrase in end_phrases):
+    if END_RE.search(user_question):
         # User wants to end the conversation
-        state["step"] = "conversation_ended"
-        state["messages"].append({
+        state.step = "conversation_ended"
+        state.messages.append({
             "role": "assistant",
-            "content": f"You're welcome, {state['name']}! I'm glad I could help with your financial planning. Best of luck with your financial goals!"
+            "content": f"You're welcome, {state.name}! I'm glad I could help with your financial planning. Best of luck with your financial goals!"
         })
-        return state
+        return None
+
+    # Definitions of common terms don't need the LLM
+    faq = FAQ_RE.search(user_question)
+    if faq:
+        FOLLOWUP_ANSWERS.labels(source="faq").inc()
+        record_followup(state, f"{FAQ[faq.group(1).lower()]}\n\nDo you have any other questions?")
+        return None
+
+    # Reuse an earlier answer if this question is a paraphrase of one already asked
+    question_vector = await embed_question(user_question)
+    if question_vector is not None and state.qa_vectors:
+        similarities = np.stack(state.qa_vectors) @ question_vector
+        best = int(similarities.argmax())
+        if similarities[best] >= SEMANTIC_CACHE_THRESHOLD:
+            FOLLOWUP_ANSWERS.labels(source="semantic_cache").inc()
+            record_followup(state, state.qa_answers[best])
+            return None
+
+    FOLLOWUP_ANSWERS.labels(source="gemini").inc()
 
     # Build context for the follow-up question
-    previous_context = "\n".join([f"- {item['content']}" for item in state['conversation_history'][-3:]])
-
-    context = (
-        f"You are a friendly and knowledgeable Indian financial advisor. Here's the context:\n"
-        f"- User's name: {state['name']}\n"
-        f"- Monthly salary: {state['salary']} INR\n"
-        f"- Initial advice given: {state.get('initial_advice', 'N/A')}\n\n"
-        f"Previous conversation:\n{previous_context}\n\n"
-        f"The user is asking a follow-up question: \"{user_question}\"\n\n"
-        f"Provide a helpful, detailed answer that builds on the previous advice. Keep it friendly and practical. "
-        f"If the question is unclear, ask for clarification. End by asking if they have any other questions."
+    history = state.conversation_history
+    recent = islice(history, max(len(history) - 3, 0), None)
+    context = FOLLOWUP_TEMPLATE(
+        name=state.name,
+        salary=state.salary,
+        initial_advice=state.initial_advice or "N/A",
+        previous_context="\n".join(f"- {item['content']}" for item in recent),
+        question=user_question
     )
+    return context, question_vector
 
-    # Get AI response for the follow-up question
-    followup_response = ask_gemini(context)
+
+def record_followup(state: State, followup_response: str, question_vector=None):
+    # Remember fresh answers so paraphrases of this question can reuse them
+    if question_vector is not None and followup_response != GEMINI_FALLBACK:
+        state.qa_vectors.append(question_vector)
+        state.qa_answers.append(followup_response)
 
     # Add to conversation history
-    state["conversation_history"].append({
+    state.conversation_history.append({
         "role": "user",
-        "content": f"Follow-up question: {user_question}"
+        "content": f"Follow-up question: {state.followup_question}"
     })
-    state["conversation_history"].append({
+    state.conversation_history.append({
         "role": "assistant",
         "content": f"Follow-up response: {followup_response}"
     })
 
-    state["messages"].append({"role": "assistant", "content": followup_response})
+    state.messages.append({"role": "assistant", "content": followup_response})
 
-    # Stay in followup step for more questions
-    return state
 
+async def handle_followup(state: State):
+    """Handle follow-up questions about financial advice"""
+    pending = await start_followup(state)
+    if pending is not None:
+        # Get AI response for the follow-up question
+        context, question_vector = pending
+        record_followup(state, await ask_gemini(context), question_vector)
 
-# Graph construction
-def build_graph():
-    graph = StateGraph(State)
-    graph.add_node("ask_name", ask_name)
-    graph.add_node("ask_salary", ask_salary)
-    graph.add_node("advice", give_advice)
-    graph.add_node("followup", handle_followup)
+    # Stay in followup step for more questions
+    return state
 
-    graph.set_entry_point("ask_name")
-    graph.add_edge("ask_name", "ask_salary")
-    graph.add_edge("ask_salary", "advice")
-    graph.add_edge("advice", "followup")
-    graph.add_edge("followup", "followup")  # Loop back for more questions
-    # The actual ending happens when handle_followup sets step to "conversation_ended"
-    return graph.compile()
 
+async def stream_followup(state: State):
+    """Yield the follow-up answer as Gemini generates it, recording it in the state once complete"""
+    pending = await start_followup(state)
+    if pending is None:
+        yield state.messages[-1]["content"]
+        return
 
-graph = build_graph()
\ No newline at end of file
+    context, question_vector = pending
+    chunks = []
+    async for chunk in stream_gemini(context):
+        chunks.append(chunk)
+        yield chunk
+    record_followup(state, "".join(chunks).strip(), question_vector)
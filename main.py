@@ -1,41 +1,86 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, constr
 from typing import Optional
+from contextlib import asynccontextmanager, aclosing
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from prometheus_client import Counter, make_asgi_app
+import redis.asyncio as redis
+import orjson
+import asyncio
+import copy
+import hashlib
+import os
 import uuid
 
-from graph import ask_name, ask_salary, give_advice, handle_followup, State
+from graph import (
+    ask_name, ask_salary, give_advice, handle_followup, State,
+    serialize_state, deserialize_state, stream_advice, stream_followup, model, embedder,
+    ASK_NAME_MSG, ASK_SALARY_TEMPLATE
+)
 import re
 
-app = FastAPI()
+# Shared session store; without it sessions stay in this process and only one worker can be used
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# Idle time before an abandoned conversation is dropped (seconds)
+SESSION_TTL = 1800
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Room for blocking calls offloaded with asyncio.to_thread (capped by graph.BLOCKING_SLOTS)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=64))
+    yield
+    # Close pooled Gemini connections cleanly
+    for client in (model.client, embedder.client):
+        await client.aio.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+class OrjsonResponse(JSONResponse):
+    """JSONResponse rendered with orjson, much faster than stdlib json on the growing messages list"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=OrjsonResponse)
+app.mount("/metrics", make_asgi_app())
+
+
+# Name-extraction patterns, compiled once at import
+NAME_RE = re.compile(
+    r"(?:(?:my name is|i'm|i am|call me|it's)\s+|name:\s*)"  # "My name is John", "I'm Sarah", "Name: Lisa", ...
+    r"(?P<name>[a-zA-Z]+(?:\s+[a-zA-Z]+)*)",
+    re.IGNORECASE
+)
+STOPWORDS_RE = re.compile(r'\b(the|a|an|is|am|are|my|me|call|name)\b', re.IGNORECASE)
+PUNCT_RE = re.compile(r'[^\w\s]')
+WS_RE = re.compile(r'\s+')
 
 
 def extract_name_from_text(text: str) -> str:
     """Extract actual name from natural language input like 'My name is John' or 'I'm Sarah'"""
     text = text.strip()
 
-    # Common patterns for name introduction
-    patterns = [
-        r"my name is\s+([a-zA-Z]+(?:\s+[a-zA-Z]+)*)",  # "My name is John" or "My name is John Smith"
-        r"i'm\s+([a-zA-Z]+(?:\s+[a-zA-Z]+)*)",  # "I'm Sarah" or "I'm Sarah Jones"
-        r"i am\s+([a-zA-Z]+(?:\s+[a-zA-Z]+)*)",  # "I am Mike" or "I am Mike Brown"
-        r"call me\s+([a-zA-Z]+(?:\s+[a-zA-Z]+)*)",  # "Call me David" or "Call me David Lee"
-        r"name:\s*([a-zA-Z]+(?:\s+[a-zA-Z]+)*)",  # "Name: Lisa" or "Name: Lisa Wilson"
-        r"it's\s+([a-zA-Z]+(?:\s+[a-zA-Z]+)*)",  # "It's Alex" or "It's Alex Taylor"
-    ]
-
-    # Try each pattern (case insensitive)
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            return match.group(1).strip()
+    # Most users just type their name
+    if text.isalpha():
+        return text[:50]
+
+    match = NAME_RE.search(text)
+    if match:
+        return match.group("name").strip()
 
     # If no pattern matches, assume the entire input is a name (but clean it)
     # Remove common non-name words and clean up
-    cleaned = re.sub(r'\b(the|a|an|is|am|are|my|me|call|name)\b', '', text, flags=re.IGNORECASE)
-    cleaned = re.sub(r'[^\w\s]', '', cleaned)  # Remove punctuation
-    cleaned = re.sub(r'\s+', ' ', cleaned).strip()  # Clean up spaces
+    cleaned = STOPWORDS_RE.sub('', text)
+    cleaned = PUNCT_RE.sub('', cleaned)  # Remove punctuation
+    cleaned = WS_RE.sub(' ', cleaned).strip()  # Clean up spaces
 
     # If result is empty or too long, return the original text trimmed
     if not cleaned or len(cleaned) > 50:
@@ -45,85 +90,159 @@ def extract_name_from_text(text: str) -> str:
 
 
 class UserInput(BaseModel):
-    name: Optional[str] = None
-    salary: Optional[float] = None
+    # Bounded lengths also cap the regex work done on each turn
+    name: Optional[constr(strip_whitespace=True, min_length=1, max_length=200)] = None
+    salary: Optional[float] = Field(default=None, gt=0, le=1e9)
     conversation_id: Optional[str] = None
-    followup_question: Optional[str] = None
+    followup_question: Optional[constr(max_length=2000)] = None
+
+
+SESSION_EVICTIONS = Counter(
+    "conversation_state_evictions",
+    "Conversation states dropped from the session store before the conversation ended",
+    ["reason"]
+)
+
+
+class SessionStore(TTLCache):
+    """TTLCache that reports evictions so the size and TTL can be tuned"""
+
+    def popitem(self):
+        item = super().popitem()
+        SESSION_EVICTIONS.labels(reason="size").inc()
+        return item
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        if expired:
+            SESSION_EVICTIONS.labels(reason="ttl").inc(len(expired))
+        return expired
+
+
+# In-memory conversation state (keyed by conversation ID), used when REDIS_URL is not set
+conversation_states = SessionStore(maxsize=10_000, ttl=SESSION_TTL)
+conversation_states_lock = asyncio.Lock()
+
+
+def session_key(conversation_id: str) -> str:
+    return f"sess:{conversation_id}"
+
+
+async def load_state(conversation_id: str):
+    if redis_client is not None:
+        data = await redis_client.get(session_key(conversation_id))
+        return deserialize_state(data) if data else None
+    async with conversation_states_lock:
+        state = conversation_states.get(conversation_id)
+    # Hand out a copy like Redis does, so a turn that fails or is abandoned midway leaves the stored state untouched
+    return copy.deepcopy(state)
+
+
+async def save_state(conversation_id: str, state: State):
+    if redis_client is not None:
+        await redis_client.set(session_key(conversation_id), serialize_state(state), ex=SESSION_TTL)
+        return
+    async with conversation_states_lock:
+        conversation_states[conversation_id] = state
+
+
+async def drop_state(conversation_id: str):
+    if redis_client is not None:
+        await redis_client.delete(session_key(conversation_id))
+        return
+    async with conversation_states_lock:
+        conversation_states.pop(conversation_id, None)
 
 
-# In-memory conversation state (keyed by conversation ID)
-conversation_states = {}
+# Greeting-turn bodies encoded once; only the name and conversation_id are spliced in per request
+ASK_NAME_BODY = orjson.dumps({"messages": [ASK_NAME_MSG], "step": "ask_name"})
+ASK_SALARY_BODY_HEAD, ASK_SALARY_BODY_TAIL = orjson.dumps({
+    "messages": [ASK_NAME_MSG, {"role": "assistant", "content": ASK_SALARY_TEMPLATE(name="\x00")}],
+    "step": "ask_salary"
+}).split(b"\\u0000")
+
+
+def greeting_response(body: bytes, conversation_id: str) -> Response:
+    # Splice conversation_id into the closing brace of a pre-encoded body
+    content = body[:-1] + b',"conversation_id":' + orjson.dumps(conversation_id) + b"}"
+    return Response(content=content, media_type="application/json")
+
+
+def ask_salary_response(state: State, conversation_id: str) -> Response:
+    name = orjson.dumps(state.name)[1:-1]
+    return greeting_response(ASK_SALARY_BODY_HEAD + name + ASK_SALARY_BODY_TAIL, conversation_id)
+
+
+def state_etag(conversation_id: str, state: State) -> str:
+    digest = hashlib.blake2b(f"{conversation_id}:{state.step}:{len(state.messages)}".encode(), digest_size=8)
+    return f'"{digest.hexdigest()}"'
+
+
+def poll_response(request: Request, etag: str, build) -> Response:
+    """Answer a poll with 304 if the client already has this state, otherwise build() tagged with the ETag"""
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+    response = build()
+    response.headers["ETag"] = etag
+    return response
 
 
 @app.post("/chat")
-async def chat(user_input: UserInput):
+async def chat(user_input: UserInput, request: Request):
     # Get or create conversation ID
     conversation_id = user_input.conversation_id
     if not conversation_id:
         conversation_id = str(uuid.uuid4())
 
-    state = conversation_states.get(conversation_id, {})
+    state = await load_state(conversation_id)
 
-    if not state:
+    if state is None:
         # Start conversation by calling ask_name
         try:
             state = State()
             state = ask_name(state)
-            conversation_states[conversation_id] = state
-            return {
-                "messages": state.get("messages", []),
-                "step": state.get("step"),
-                "conversation_id": conversation_id
-            }
+            await save_state(conversation_id, state)
+            return greeting_response(ASK_NAME_BODY, conversation_id)
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error starting conversation: {str(e)}")
 
-    step = state.get("step")
+    step = state.step
 
     if step == "ask_name":
         if user_input.name is None:
             # Return current messages (asking for name)
-            return {
-                "messages": state.get("messages", []),
-                "step": step,
-                "conversation_id": conversation_id
-            }
+            return poll_response(
+                request, state_etag(conversation_id, state),
+                lambda: greeting_response(ASK_NAME_BODY, conversation_id)
+            )
         else:
             # User provided name, extract actual name from natural language input
             try:
                 extracted_name = extract_name_from_text(user_input.name)
-                state["name"] = extracted_name
+                state.name = extracted_name
                 state = ask_salary(state)
-                conversation_states[conversation_id] = state
-                return {
-                    "messages": state.get("messages", []),
-                    "step": state.get("step"),
-                    "conversation_id": conversation_id
-                }
+                await save_state(conversation_id, state)
+                return ask_salary_response(state, conversation_id)
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"Error processing name: {str(e)}")
 
     elif step == "ask_salary":
         if user_input.salary is None:
             # Return current messages (asking for salary)
-            return {
-                "messages": state.get("messages", []),
-                "step": step,
-                "conversation_id": conversation_id
-            }
+            return poll_response(
+                request, state_etag(conversation_id, state),
+                lambda: ask_salary_response(state, conversation_id)
+            )
         else:
-            # Validate salary input
-            if not isinstance(user_input.salary, (int, float)) or user_input.salary <= 0:
-                raise HTTPException(status_code=400, detail="Please provide a valid positive salary amount")
-
             # User provided salary, generate advice
             try:
-                state["salary"] = user_input.salary
-                state = give_advice(state)
-                conversation_states[conversation_id] = state
+                state.salary = user_input.salary
+                state = await give_advice(state)
+                await save_state(conversation_id, state)
                 return {
-                    "messages": state.get("messages", []),
-                    "step": state.get("step"),
+                    "messages": state.messages,
+                    "step": state.step,
                     "conversation_id": conversation_id
                 }
             except Exception as e:
@@ -132,33 +251,36 @@ async def chat(user_input: UserInput):
     elif step == "followup":
         if user_input.followup_question is None:
             # Return current messages (asking for follow-up or showing advice)
-            return {
-                "messages": state.get("messages", []),
-                "step": step,
-                "conversation_id": conversation_id
-            }
+            return poll_response(
+                request, state_etag(conversation_id, state),
+                lambda: OrjsonResponse({
+                    "messages": state.messages,
+                    "step": step,
+                    "conversation_id": conversation_id
+                })
+            )
         else:
             # User provided a follow-up question
             try:
-                state["followup_question"] = user_input.followup_question
-                state = handle_followup(state)
-                conversation_states[conversation_id] = state
+                state.followup_question = user_input.followup_question
+                state = await handle_followup(state)
+                await save_state(conversation_id, state)
 
                 # Check if conversation ended
-                if state.get("step") == "conversation_ended":
+                if state.step == "conversation_ended":
                     final_response = {
-                        "messages": state.get("messages", []),
+                        "messages": state.messages,
                         "step": "conversation_ended",
                         "conversation_id": conversation_id,
                         "conversation_ended": True
                     }
                     # Clean up this conversation
-                    conversation_states.pop(conversation_id, None)
+                    await drop_state(conversation_id)
                     return final_response
                 else:
                     return {
-                        "messages": state.get("messages", []),
-                        "step": state.get("step"),
+                        "messages": state.messages,
+                        "step": state.step,
                         "conversation_id": conversation_id
                     }
             except Exception as e:
@@ -167,21 +289,72 @@ async def chat(user_input: UserInput):
     elif step == "conversation_ended":
         # This shouldn't normally happen, but handle gracefully
         final_response = {
-            "messages": state.get("messages", []),
+            "messages": state.messages,
             "step": "conversation_ended",
             "conversation_id": conversation_id,
             "conversation_ended": True
         }
         # Clean up this conversation
-        conversation_states.pop(conversation_id, None)
+        await drop_state(conversation_id)
         return final_response
 
     else:
         # Invalid state, clean up and start over
-        conversation_states.pop(conversation_id, None)
+        await drop_state(conversation_id)
         raise HTTPException(status_code=400, detail="Invalid conversation state. Please start a new conversation.")
 
 
+def sse_event(event: str, data: bytes) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + data + b"\n\n"
+
+
+@app.post("/chat/stream")
+async def chat_stream(user_input: UserInput, request: Request):
+    """Same conversation flow as /chat, but Gemini replies arrive as server-sent "token" events.
+
+    A final "done" event carries the usual /chat response body.
+    """
+    conversation_id = user_input.conversation_id
+    state = await load_state(conversation_id) if conversation_id else None
+    step = state.step if state is not None else None
+
+    if step == "ask_salary" and user_input.salary is not None:
+        state.salary = user_input.salary
+        tokens = stream_advice(state)
+    elif step == "followup" and user_input.followup_question is not None:
+        state.followup_question = user_input.followup_question
+        tokens = stream_followup(state)
+    else:
+        # Nothing to generate for this turn, send the regular response as a single event
+        response = await chat(user_input, request)
+        if isinstance(response, Response) and response.status_code == 304:
+            return response
+        body = response.body if isinstance(response, Response) else orjson.dumps(response)
+        return StreamingResponse(iter([sse_event("done", body)]), media_type="text/event-stream")
+
+    async def events():
+        async with aclosing(tokens):
+            async for token in tokens:
+                # Closing the token stream cancels the Gemini request for an abandoned client
+                if await request.is_disconnected():
+                    return
+                yield sse_event("token", orjson.dumps({"content": token}))
+
+        response = {
+            "messages": state.messages,
+            "step": state.step,
+            "conversation_id": conversation_id
+        }
+        if state.step == "conversation_ended":
+            response["conversation_ended"] = True
+            await drop_state(conversation_id)
+        else:
+            await save_state(conversation_id, state)
+        yield sse_event("done", orjson.dumps(response))
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 # Serve the HTML file
 @app.get("/")
 async def read_index():
@@ -191,4 +364,6 @@ async def read_index():
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+    # Any worker can serve any turn once sessions live in Redis
+    workers = (os.cpu_count() or 1) if redis_client is not None else 1
+    uvicorn.run("main:app", host="0.0.0.0", port=5000, workers=workers)
\ No newline at end of file
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+from langchain_core.messages import AIMessage
+
+# graph.py refuses to import without a key; the tests never reach Gemini
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("ADVICE_CACHE_DIR", tempfile.mkdtemp(prefix="advice_cache_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import graph  # noqa: E402
+
+
+class FakeModel:
+    """Stands in for the Gemini chat model, recording every prompt it receives"""
+
+    def __init__(self, reply="Plan for {NAME}", chunks=None, fail_after=None, delay=0):
+        self.reply = reply
+        self.chunks = chunks if chunks is not None else [reply]
+        self.fail_after = fail_after
+        self.delay = delay
+        self.prompts = []
+
+    async def ainvoke(self, messages, **kwargs):
+        self.prompts.append(messages[-1].content)
+        await asyncio.sleep(self.delay)
+        return AIMessage(content=self.reply)
+
+    async def astream(self, messages, **kwargs):
+        self.prompts.append(messages[-1].content)
+        for i, chunk in enumerate(self.chunks):
+            if i == self.fail_after:
+                raise RuntimeError("stream dropped")
+            yield AIMessage(content=chunk)
+
+
+class FakeEmbedder:
+    async def aembed_query(self, question):
+        raise RuntimeError("embeddings unavailable")
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    model = FakeModel()
+    monkeypatch.setattr(graph, "model", model)
+    monkeypatch.setattr(graph, "embedder", FakeEmbedder())
+    graph.advice_cache().clear()
+    return model
@@ -0,0 +1,149 @@
+import asyncio
+from collections import deque
+
+import numpy as np
+import pytest
+
+import graph
+
+
+def test_state_round_trip_restores_ring_buffers_and_vectors():
+    state = graph.State(name="Appu", salary=42000.0, step="followup", initial_advice="Save more")
+    state.messages.append({"role": "assistant", "content": "Save more"})
+    for i in range(graph.HISTORY_WINDOW + 2):
+        state.conversation_history.append({"role": "user", "content": f"question {i}"})
+    for i in range(graph.SEMANTIC_CACHE_SIZE + 3):
+        state.qa_vectors.append(np.full(4, i, dtype=np.float32))
+        state.qa_answers.append(f"answer {i}")
+
+    restored = graph.deserialize_state(graph.serialize_state(state))
+
+    assert (restored.name, restored.salary, restored.step, restored.initial_advice) == ("Appu", 42000.0, "followup", "Save more")
+    assert restored.messages == state.messages
+    assert isinstance(restored.conversation_history, deque)
+    assert restored.conversation_history.maxlen == graph.HISTORY_WINDOW
+    assert list(restored.conversation_history) == list(state.conversation_history)
+    assert restored.qa_vectors.maxlen == restored.qa_answers.maxlen == graph.SEMANTIC_CACHE_SIZE
+    assert list(restored.qa_answers) == [f"answer {i}" for i in range(3, graph.SEMANTIC_CACHE_SIZE + 3)]
+    for vector, expected in zip(restored.qa_vectors, state.qa_vectors):
+        assert vector.dtype == np.float32
+        np.testing.assert_array_equal(vector, expected)
+
+
+def test_default_state_round_trip():
+    restored = graph.deserialize_state(graph.serialize_state(graph.State()))
+    assert restored == graph.State()
+
+
+def test_coalesce_shares_one_call_between_identical_prompts(fake_model):
+    fake_model.delay = 0.01
+
+    async def run():
+        answers = await asyncio.gather(*(graph.ask_gemini("same prompt") for _ in range(5)))
+        return answers, await graph.ask_gemini("other prompt")
+
+    answers, other = asyncio.run(run())
+    assert answers == [fake_model.reply] * 5
+    assert other == fake_model.reply
+    assert fake_model.prompts == ["same prompt", "other prompt"]
+    assert graph._inflight == {}
+
+
+def test_coalesce_survives_a_cancelled_caller(fake_model):
+    fake_model.delay = 0.01
+
+    async def run():
+        first = asyncio.create_task(graph.ask_gemini("same prompt"))
+        second = asyncio.create_task(graph.ask_gemini("same prompt"))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second, first
+
+    answer, first = asyncio.run(run())
+    assert first.cancelled()
+    assert answer == fake_model.reply
+    assert len(fake_model.prompts) == 1
+    assert graph._inflight == {}
+
+
+@pytest.mark.parametrize("question, term", [
+    ("What is SIP?", "sip"),
+    ("define ELSS", "elss"),
+    ("what are index funds", "index fund"),
+    ("whats ppf", "ppf"),
+    ("Can you explain term insurance?! ", "term insurance"),
+    ("What's an emergency fund.", "emergency fund"),
+])
+def test_faq_matches_bare_definitions(question, term):
+    match = graph.FAQ_RE.search(question)
+    assert match and match.group(1).lower() == term
+
+
+@pytest.mark.parametrize("question", [
+    "what is SIP return for 5000 a month?",
+    "what are index funds giving these days",
+    "Explain ELSS vs PPF which is better for me",
+    "What is the best SIP for me?",
+    "how much should I put in SIP?",
+])
+def test_faq_leaves_specific_questions_to_gemini(question):
+    assert graph.FAQ_RE.search(question) is None
+
+
+async def collect(agen):
+    return [item async for item in agen]
+
+
+async def from_list(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.parametrize("chunks", [
+    ["Hi {NAME}, here is your plan"],
+    ["Hi {", "NAME}, here is your plan"],
+    ["Hi {NA", "ME", "}, here is your plan"],
+    ["Hi ", "{", "N", "A", "M", "E", "}", ", here is your plan"],
+])
+def test_fill_name_reassembles_split_placeholders(chunks):
+    out = asyncio.run(collect(graph.fill_name(from_list(chunks), "Appu")))
+    assert "".join(out) == "Hi Appu, here is your plan"
+    assert not any("{" in piece for piece in out)
+
+
+def test_fill_name_passes_through_other_braces():
+    out = asyncio.run(collect(graph.fill_name(from_list(["Save {", "50%} of it", " {"]), "Appu")))
+    assert "".join(out) == "Save {50%} of it {"
+
+
+@pytest.mark.parametrize("salary, bucket", [
+    (1500, 1500),
+    (7400, 7400),
+    (52345, 52000),
+    (126000, 130000),
+])
+def test_salary_bucket_stays_close_to_the_real_salary(salary, bucket):
+    assert graph.salary_bucket(salary) == bucket
+    assert abs(salary - bucket) / salary <= 0.05
+
+
+def test_truncated_advice_stream_is_not_cached(fake_model):
+    fake_model.chunks = ["Plan for {NAME}: ", "save 20%", "..."]
+    fake_model.fail_after = 2
+    state = graph.State(name="Appu", salary=50000.0, step="ask_salary")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(collect(graph.stream_advice(state)))
+    assert asyncio.run(graph.cached_advice(state)) is None
+    assert state.initial_advice == ""
+
+    fake_model.fail_after = None
+    out = asyncio.run(collect(graph.stream_advice(state)))
+    assert "".join(out) == "Plan for Appu: save 20%..."
+    assert asyncio.run(graph.cached_advice(graph.State(name="Ravi", salary=50400.0))) == "Plan for Ravi: save 20%..."
+
+
+def test_stream_failure_before_any_text_falls_back(fake_model):
+    fake_model.fail_after = 0
+    out = asyncio.run(collect(graph.stream_gemini("prompt")))
+    assert out == [graph.GEMINI_FALLBACK]
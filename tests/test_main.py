@@ -0,0 +1,62 @@
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+import main
+
+
+def start_conversation(client, name="Appu"):
+    conversation_id = client.post("/chat", json={}).json()["conversation_id"]
+    client.post("/chat", json={"conversation_id": conversation_id, "name": name})
+    return conversation_id
+
+
+def test_abandoned_stream_keeps_stored_step(fake_model, monkeypatch):
+    client = TestClient(main.app)
+    conversation_id = start_conversation(client)
+
+    async def disconnected(self):
+        return True
+
+    with monkeypatch.context() as patch:
+        patch.setattr(Request, "is_disconnected", disconnected)
+        response = client.post("/chat/stream", json={"conversation_id": conversation_id, "salary": 50000})
+    assert "event: done" not in response.text
+    assert main.conversation_states[conversation_id].step == "ask_salary"
+
+    # The retry is served normally instead of hitting the invalid-state 400
+    response = client.post("/chat/stream", json={"conversation_id": conversation_id, "salary": 50000})
+    assert response.status_code == 200
+    assert '"step":"followup"' in response.text
+    assert main.conversation_states[conversation_id].step == "followup"
+
+
+def poll(if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match is not None else []
+    request = Request({"type": "http", "method": "POST", "path": "/chat", "headers": headers})
+    return main.poll_response(request, '"abc"', lambda: main.OrjsonResponse({"step": "ask_name"}))
+
+
+@pytest.mark.parametrize("if_none_match", ['"abc"', 'W/"abc"', '"old", "abc"', ' W/"old" ,W/"abc" '])
+def test_poll_matching_etag_is_not_modified(if_none_match):
+    response = poll(if_none_match)
+    assert response.status_code == 304
+    assert response.headers["etag"] == '"abc"'
+    assert response.body == b""
+
+
+@pytest.mark.parametrize("if_none_match", [None, "", '"old"', 'abc', '"abcd"'])
+def test_poll_other_etag_gets_full_body(if_none_match):
+    response = poll(if_none_match)
+    assert response.status_code == 200
+    assert response.headers["etag"] == '"abc"'
+    assert response.body == b'{"step":"ask_name"}'
+
+
+def test_unchanged_chat_poll_returns_304(fake_model):
+    client = TestClient(main.app)
+    conversation_id = client.post("/chat", json={}).json()["conversation_id"]
+    first = client.post("/chat", json={"conversation_id": conversation_id})
+    assert first.status_code == 200
+    again = client.post("/chat", json={"conversation_id": conversation_id}, headers={"If-None-Match": first.headers["etag"]})
+    assert again.status_code == 304